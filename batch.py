@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import functools
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import pandas as pd
+
+import inference
+from get_hierarchy import main, save_data, aggregate_hierarchy_data
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+
+# Exit codes reported by the command-line entry point
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_PARTIAL = 3
+
+# GLEIF requests allowed per time window across all shards of a name matching run
+DEFAULT_REQUEST_LIMIT = 45
+
+
+# Read a list of LEI codes or company names from a CSV, Parquet, JSONL, Excel or plain text file
+def read_inputs(file_path, column=None):
+    if file_path.endswith('.csv') and column is None:
+        # Without a column name the CSV has no header and is split on commas like the dashboard's upload;
+        # lines may hold any number of values, so every cell is an input
+        with open(file_path, 'r') as f:
+            values = re.split(r'[,\r\n]', f.read())
+        df = pd.DataFrame({'value': values})
+    elif file_path.endswith('.csv'):
+        df = pd.read_csv(file_path, dtype=str)
+    elif file_path.endswith('.parquet'):
+        df = pd.read_parquet(file_path)
+    elif file_path.endswith('.jsonl'):
+        df = pd.read_json(file_path, lines=True, dtype=False)
+    elif file_path.endswith('.xlsx'):
+        df = pd.read_excel(file_path, dtype=str)
+    else:
+        with open(file_path, 'r') as f:
+            values = f.read().splitlines()
+        df = pd.DataFrame({'value': values})
+
+    column = column or df.columns[0]
+    if column not in df.columns:
+        raise ValueError(f"Column '{column}' not found in {file_path}")
+
+    # Strip blanks and drop duplicates while keeping the original order
+    values = [str(value).strip() for value in df[column].dropna().tolist()]
+    values = list(dict.fromkeys(value for value in values if value))
+    if not values:
+        raise ValueError(f"No inputs found in {file_path}")
+    return values
+
+
+# Write a DataFrame to CSV, Parquet or JSONL depending on the file extension
+def write_output(df, file_path):
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if file_path.endswith('.parquet'):
+        df.to_parquet(file_path, index=False)
+    elif file_path.endswith('.jsonl'):
+        df.to_json(file_path, orient='records', lines=True, force_ascii=False)
+    else:
+        df.to_csv(file_path, index=False)
+    logging.info(f"Wrote {len(df)} rows to {file_path}")
+
+
+# Select the part of the input handled by this process when a job is split across several processes
+def select_shard(values, shard_index=0, num_shards=1):
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard {shard_index} of {num_shards}")
+    return values[shard_index::num_shards]
+
+
+# Keep the Level_<n>_<field> columns in hierarchy order after combining chunks of different depths
+def order_level_columns(df):
+    fields = ['ID', 'Name', 'SP_Global']
+
+    def level_key(col):
+        _, level, field = col.split('_', 2)
+        return int(level), fields.index(field)
+
+    return df[sorted(df.columns, key=level_key)]
+
+
+# A hierarchy counts as resolved when its root was found; build_hierarchy leaves a root without
+# an LEI or name when the GLEIF lookup fails
+def is_resolved(hierarchy):
+    root_lei, details = next(iter(hierarchy.items()), (None, None))
+    return root_lei is not None and isinstance(details, dict) and details.get('name') is not None
+
+
+# Fetch, flatten and optionally save the hierarchies for a list of LEI codes
+def run_hierarchy(lei_list, output_file_path, batch_size=10, delay=15, chunk_size=500,
+                  datasources='Datasources', save=False):
+    json_data_file = os.path.join(datasources, 'lei_data.json')
+    extracted_data_file_path = os.path.join(datasources, 'extracted_data.csv')
+    aggregated_file_path = os.path.join(datasources, 'aggregated_hierarchy.csv')
+
+    frames = []
+    resolved = set()
+    failed_chunks = 0
+
+    # Work through the input in chunks so long runs persist progress as they go;
+    # LEIs saved by an earlier chunk or run are served from the cache
+    for i in range(0, len(lei_list), chunk_size):
+        chunk = lei_list[i:i + chunk_size]
+        extracted_data, json_data = asyncio.run(
+            main(chunk, batch_size=batch_size, delay=delay, cache_file=json_data_file))
+
+        if extracted_data is None:
+            logging.error(f"No hierarchy data returned for LEIs {i + 1}-{i + len(chunk)}")
+            failed_chunks += 1
+            continue
+
+        resolved.update(lei for lei in chunk if lei in json_data and is_resolved(json_data[lei]))
+        frames.append(extracted_data)
+
+        if save:
+            requested_data = {lei: json_data[lei] for lei in chunk if lei in json_data}
+            save_data(extracted_data, requested_data, json_data_file, extracted_data_file_path)
+            aggregate_hierarchy_data(extracted_data, aggregated_file_path)
+
+        logging.info(f"Completed {i + len(chunk)}/{len(lei_list)} LEIs")
+
+    final_df = order_level_columns(pd.concat(frames, ignore_index=True)) if frames else pd.DataFrame()
+    write_output(final_df, output_file_path)
+
+    return {
+        "inputs": len(lei_list),
+        "resolved": len(resolved),
+        "unresolved": [lei for lei in lei_list if lei not in resolved],
+        "failed_chunks": failed_chunks,
+        "rows": len(final_df),
+    }
+
+
+# Load the name matching module, which is stored without a .py extension, once per process
+@functools.lru_cache(maxsize=None)
+def load_mapping_module(file_path='mapping_new'):
+    loader = importlib.machinery.SourceFileLoader('mapping_new', file_path)
+    spec = importlib.util.spec_from_loader('mapping_new', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+# Search GLEIF for company names and rank the candidates by similarity
+def run_name_matching(names, output_file_path, concurrency=20, request_limit=DEFAULT_REQUEST_LIMIT, time_window=60,
+                      backend=None, threads=None):
+    mapping = load_mapping_module()
+
+    # The request budget is shared by all lookups in this process through the module-level counters
+    mapping.REQUEST_LIMIT = request_limit
+    mapping.TIME_WINDOW = time_window
+
+    frames = []
+    for i in range(0, len(names), concurrency):
+        batch = names[i:i + concurrency]
+        results = asyncio.run(mapping.fetch_all_companies(batch))
+        frames.append(mapping.process_results(results, backend=backend, threads=threads))
+        logging.info(f"Matched {i + len(batch)}/{len(names)} names")
+
+    frames = [df for df in frames if not df.empty]
+    if frames:
+        final_df = pd.concat(frames, ignore_index=True).sort_values(
+            by=["Similarity Score", "Exact Match", "Length Difference"], ascending=[False, False, True])
+        matched = set(final_df["Query Name"])
+    else:
+        final_df = pd.DataFrame()
+        matched = set()
+    write_output(final_df, output_file_path)
+
+    return {
+        "inputs": len(names),
+        "resolved": len(matched),
+        "unresolved": [name for name in names if name not in matched],
+        "failed_chunks": 0,
+        "rows": len(final_df),
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Run the LEI hierarchy and name matching pipelines without the dashboard.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('input', help="Input file (.csv, .parquet, .jsonl, .xlsx or one value per line)")
+    common.add_argument('output', help="Output file (.csv, .parquet or .jsonl)")
+    common.add_argument('--column', help="Input column to read; CSV files are read with a header row only when this is given "
+                             "(defaults to every cell of a headerless CSV, or the first column of other formats)")
+    common.add_argument('--shard-index', type=int, default=0, help="Shard handled by this process")
+    common.add_argument('--num-shards', type=int, default=1, help="Total number of shards the input is split into")
+    common.add_argument('--report', help="Write the summary report as JSON to this file")
+
+    hierarchy = subparsers.add_parser('hierarchy', parents=[common], help="Fetch and flatten LEI hierarchies")
+    hierarchy.add_argument('--batch-size', type=int, default=10, help="LEIs fetched concurrently")
+    hierarchy.add_argument('--delay', type=float, default=15, help="Seconds to wait between batches")
+    hierarchy.add_argument('--chunk-size', type=int, default=500, help="LEIs processed between checkpoints")
+    hierarchy.add_argument('--datasources', default='Datasources', help="Directory holding the cached data files")
+    hierarchy.add_argument('--save', action='store_true',
+                           help="Save fetched hierarchies to the cache and aggregated files after each chunk; "
+                                "shards can share one --datasources directory as writes are serialised with lock files")
+
+    names = subparsers.add_parser('names', parents=[common], help="Match company names to LEI records")
+    names.add_argument('--concurrency', type=int, default=20, help="Names searched concurrently")
+    names.add_argument('--request-limit', type=int,
+                       help="Requests this shard may send per time window; each shard keeps its own budget, so the "
+                            "total rate is this times --num-shards (defaults to 45 divided across the shards)")
+    names.add_argument('--time-window', type=float, default=60, help="Length of the rate limit window in seconds")
+    names.add_argument('--backend', choices=inference.BACKENDS, help="Embedding inference backend (defaults to $EMBEDDING_BACKEND or torch)")
+    names.add_argument('--threads', type=int, help="Intra-op threads used for embedding inference")
+
+    return parser
+
+
+def cli(argv=None):
+    args = build_parser().parse_args(argv)
+    start_time = time.time()
+
+    try:
+        values = select_shard(read_inputs(args.input, args.column), args.shard_index, args.num_shards)
+        logging.info(f"Shard {args.shard_index + 1}/{args.num_shards}: {len(values)} inputs")
+
+        if args.command == 'hierarchy':
+            summary = run_hierarchy(values, args.output, batch_size=args.batch_size, delay=args.delay,
+                                    chunk_size=args.chunk_size, datasources=args.datasources, save=args.save)
+        else:
+            # Split the GLEIF budget between the shards unless a per-shard limit was given
+            request_limit = args.request_limit or max(1, DEFAULT_REQUEST_LIMIT // args.num_shards)
+            summary = run_name_matching(values, args.output, concurrency=args.concurrency,
+                                        request_limit=request_limit, time_window=args.time_window,
+                                        backend=args.backend, threads=args.threads)
+    except Exception as e:
+        logging.error(f"Batch {args.command} run failed: {e}")
+        summary = {"error": str(e)}
+        exit_code = EXIT_FAILURE
+    else:
+        exit_code = EXIT_PARTIAL if summary["unresolved"] or summary["failed_chunks"] else EXIT_OK
+
+    summary.update({
+        "command": args.command,
+        "shard": f"{args.shard_index + 1}/{args.num_shards}",
+        "output": args.output,
+        "elapsed_seconds": round(time.time() - start_time, 1),
+        "exit_code": exit_code,
+    })
+
+    report = json.dumps(summary, indent=2)
+    print(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(report)
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
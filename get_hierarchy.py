@@ -6,66 +6,63 @@ import pandas as pd
 import logging
 import networkx as nx
 import tempfile
+from collections import ChainMap
+from collections.abc import Mapping
 from pyvis.network import Network
+from hierarchy_store import HierarchyStore, file_lock
 
 
 logging.basicConfig(level=logging.INFO)
 
 
-def save_data(extracted_data, json_data):
-    # Paths to the data files
-    json_data_file = 'Datasources/lei_data.json'
-    extracted_data_file_path = 'Datasources/extracted_data.csv'
+# Compact hierarchy cache kept next to the legacy JSON file
+def hierarchy_store_path(json_data_file):
+    return os.path.join(os.path.dirname(json_data_file), 'lei_hierarchy')
 
-    # Load existing JSON data if the file exists
-    if os.path.exists(json_data_file):
-        with open(json_data_file, 'r') as f:
-            existing_json_data = json.load(f)
-    else:
-        existing_json_data = []
-
-    # Ensure json_data is a dictionary
-    if not isinstance(json_data, dict):
-        raise ValueError("json_data must be a dictionary")
-
-    # Convert json_data to a list of dictionaries
-    json_data_list = [{lei: details} for lei, details in json_data.items()]
 
-    # Extract LEIs from the new json_data
-    new_leis = set(json_data.keys())
+def save_data(extracted_data, json_data, json_data_file='Datasources/lei_data.json',
+              extracted_data_file_path='Datasources/extracted_data.csv'):
+    # Load the existing cached hierarchies
+    existing_hierarchies = load_saved_hierarchies(json_data_file)
 
-    # Extract LEIs from the existing json_data
-    existing_leis = {list(entry.keys())[0] for entry in existing_json_data}
+    # Ensure json_data is a mapping of LEI to hierarchy
+    if not isinstance(json_data, Mapping):
+        raise ValueError("json_data must be a dictionary")
 
-    # Filter out LEIs that already exist in the existing JSON data
-    filtered_json_data_list = [entry for entry in json_data_list if list(entry.keys())[0] not in existing_leis]
+    # Filter out LEIs that already exist in the cache before materializing any hierarchy
+    new_json_data = {lei: json_data[lei] for lei in json_data if lei not in existing_hierarchies}
 
-    # Append new data to the json_data_file
-    if filtered_json_data_list:
-        existing_json_data.extend(filtered_json_data_list)
-        with open(json_data_file, 'w') as f:
-            json.dump(existing_json_data, f)
-        logging.info(f"Appended {len(filtered_json_data_list)} new LEIs to the JSON file.")
+    # Merge the new hierarchies into the compact cache
+    if new_json_data:
+        HierarchyStore.append(hierarchy_store_path(json_data_file), new_json_data, base=existing_hierarchies)
+        logging.info(f"Appended {len(new_json_data)} new LEIs to the hierarchy cache.")
     else:
         logging.info("No new LEIs to add.")
 
-    # Save only new extracted_data to the CSV file
-    if os.path.exists(extracted_data_file_path):
-        existing_extracted_data = pd.read_csv(extracted_data_file_path)
-        new_extracted_data = extracted_data[~extracted_data['Level_1_ID'].isin(existing_extracted_data['Level_1_ID'])]
-        if not new_extracted_data.empty:
-            combined_data = pd.concat([existing_extracted_data, new_extracted_data])
-            combined_data.to_csv(extracted_data_file_path, index=False)
-            logging.info(f"Appended {len(new_extracted_data)} new LEIs to the CSV file.")
+    # Save only new extracted_data to the CSV file, one writer at a time
+    with file_lock(f"{extracted_data_file_path}.lock"):
+        if os.path.exists(extracted_data_file_path):
+            existing_extracted_data = pd.read_csv(extracted_data_file_path)
+            new_extracted_data = extracted_data[~extracted_data['Level_1_ID'].isin(existing_extracted_data['Level_1_ID'])]
+            if not new_extracted_data.empty:
+                combined_data = pd.concat([existing_extracted_data, new_extracted_data])
+                combined_data.to_csv(extracted_data_file_path, index=False)
+                logging.info(f"Appended {len(new_extracted_data)} new LEIs to the CSV file.")
+            else:
+                logging.info("No new LEIs to add to the CSV file.")
         else:
-            logging.info("No new LEIs to add to the CSV file.")
-    else:
-        extracted_data.to_csv(extracted_data_file_path, index=False)
-        logging.info("Extracted data saved to new CSV file.")
+            extracted_data.to_csv(extracted_data_file_path, index=False)
+            logging.info("Extracted data saved to new CSV file.")
     
 
-# Load previously saved hierarchies
+# Load previously saved hierarchies, memory-mapping the compact cache so sessions share it read-only
 def load_saved_hierarchies(file_path='Datasources/lei_data.json'):
+    store_path = hierarchy_store_path(file_path)
+    if HierarchyStore.exists(store_path):
+        return HierarchyStore.load(store_path)
+
+    # Fall back to the legacy JSON list of {lei: hierarchy} entries until the compact cache is first published;
+    # lei_data.json is no longer written after that, so it is never read again once a manifest exists
     if os.path.exists(file_path):
         with open(file_path, 'r') as f:
             logging.info(f"Loading cached hierarchies from {file_path}")
@@ -78,13 +75,13 @@ def load_saved_hierarchies(file_path='Datasources/lei_data.json'):
                         all_hierarchies.update(item)
                     else:
                         logging.warning(f"Expected a dictionary but got {type(item)} in the list. Skipping item.")
-                return all_hierarchies
+                return HierarchyStore.from_hierarchies(all_hierarchies)
             else:
-                logging.warning(f"Expected a list but got {type(data)}. Returning an empty dictionary.")
-                return {}
+                logging.warning(f"Expected a list but got {type(data)}. Returning an empty cache.")
+                return HierarchyStore.from_hierarchies({})
     else:
-        logging.warning(f"File {file_path} does not exist. Returning an empty dictionary.")
-        return {}
+        logging.warning(f"File {file_path} does not exist. Returning an empty cache.")
+        return HierarchyStore.from_hierarchies({})
 
 
 async def fetch(session, url):
@@ -158,29 +155,47 @@ async def build_hierarchy(session, lei):
         return {lei: {"name": None, "spglobal": None, "children": {}}}
 
 
-async def process_single_lei(session, lei, all_hierarchies):
+# Check whether an LEI appears anywhere in a {lei: {"children": {...}}} hierarchy
+def hierarchy_contains(hierarchy, lei):
+    pending = [hierarchy]
+    while pending:
+        nodes = pending.pop()
+        if lei in nodes:
+            return True
+        pending.extend(details.get('children') or {} for details in nodes.values() if isinstance(details, dict))
+    return False
+
+
+async def process_single_lei(session, lei, all_hierarchies, cached_hierarchies=None):
     try:
         ultimate_parent = await get_ultimate_parent(session, lei) or lei
-        hierarchy = await build_hierarchy(session, ultimate_parent)
+
+        # Reuse the group's cached tree only if it already includes this LEI; a new subsidiary
+        # needs the tree fetched again
+        hierarchy = cached_hierarchies.subtree(ultimate_parent) if cached_hierarchies is not None else None
+        if hierarchy is None or not hierarchy_contains(hierarchy, lei):
+            hierarchy = await build_hierarchy(session, ultimate_parent)
         all_hierarchies[lei] = hierarchy
     except Exception as e:
         logging.error(f"Error processing LEI: {lei}, error: {e}")
 
 
-async def process_leis(lei_list, batch_size=10, delay=15):
-    all_hierarchies = load_saved_hierarchies()
-    keys = all_hierarchies.keys()
-
+async def process_leis(lei_list, batch_size=10, delay=15, cache_file='Datasources/lei_data.json'):
+    cached_hierarchies = load_saved_hierarchies(cache_file)
 
-    leis_to_process = [lei for lei in lei_list if lei not in all_hierarchies]
+    leis_to_process = [lei for lei in lei_list if lei not in cached_hierarchies]
     if not leis_to_process:
         logging.info("All requested LEIs found in cache. No processing needed.")
-        return all_hierarchies
+        return cached_hierarchies
+
+    # Newly fetched hierarchies are layered over the read-only cache
+    new_hierarchies = {}
+    all_hierarchies = ChainMap(new_hierarchies, cached_hierarchies)
 
     async with aiohttp.ClientSession() as session:
         for i in range(0, len(leis_to_process), batch_size):
             batch = leis_to_process[i:i + batch_size]
-            tasks = [process_single_lei(session, lei, all_hierarchies) for lei in batch]
+            tasks = [process_single_lei(session, lei, new_hierarchies, cached_hierarchies) for lei in batch]
             await asyncio.gather(*tasks)
             logging.info(f"Processed {i + len(batch)}/{len(leis_to_process)} LEIs")
 
@@ -196,7 +211,6 @@ async def process_leis(lei_list, batch_size=10, delay=15):
 
 
 def flatten_hierarchy(data, path=[]):
-    print(data)
     rows = []
     if data is None:
         return rows  # Return empty list if data is None
@@ -379,27 +393,28 @@ def aggregate_hierarchy_data(df, output_file_path='Datasources/aggregated_hierar
         "SP_Global": pd.Series(spglobal).reset_index(drop=True)
     })
 
-    # Check if the output file already exists
-    if os.path.exists(output_file_path):
-        # Load the existing data
-        existing_df = pd.read_csv(output_file_path)
-        # Concatenate the new data with the existing data
-        combined_df = pd.concat([existing_df, new_data_df])
-    else:
-        # If the file does not exist, the combined DataFrame is just the new data
-        combined_df = new_data_df
-        
+    # Read, merge and rewrite the output file one writer at a time
+    with file_lock(f"{output_file_path}.lock"):
+        # Check if the output file already exists
+        if os.path.exists(output_file_path):
+            # Load the existing data
+            existing_df = pd.read_csv(output_file_path)
+            # Concatenate the new data with the existing data
+            combined_df = pd.concat([existing_df, new_data_df])
+        else:
+            # If the file does not exist, the combined DataFrame is just the new data
+            combined_df = new_data_df
 
-    # Remove duplicates across the entire DataFrame based on 'ID', 'Name', and 'SP_Global'
-    final_df = combined_df.drop_duplicates(subset=["ID", "Name", "SP_Global"]).reset_index(drop=True)
+        # Remove duplicates across the entire DataFrame based on 'ID', 'Name', and 'SP_Global'
+        final_df = combined_df.drop_duplicates(subset=["ID", "Name", "SP_Global"]).reset_index(drop=True)
 
-    # Save the final DataFrame to a CSV file, overwriting the existing file
-    final_df.to_csv(output_file_path, index=False)
+        # Save the final DataFrame to a CSV file, overwriting the existing file
+        final_df.to_csv(output_file_path, index=False)
 
 # Process a subset of the LEI codes
-async def main(lei_list):
+async def main(lei_list, batch_size=10, delay=15, cache_file='Datasources/lei_data.json'):
     try:
-        all_hierarchies = await process_leis(lei_list)
+        all_hierarchies = await process_leis(lei_list, batch_size=batch_size, delay=delay, cache_file=cache_file)
 
         # Flattening the hierarchical data
         flat_data = flatten_hierarchy([all_hierarchies[lei] for lei in lei_list if lei in all_hierarchies])
@@ -0,0 +1,401 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+
+# Arrays making up a segment, each saved as its own .npy file so it can be memory-mapped
+ARRAYS = [
+    'node_leis',      # LEI of every node (fixed-width bytes)
+    'node_order',     # Node ids sorted by LEI, for binary search
+    'child_offsets',  # CSR offsets into child_index, one per node plus one
+    'child_index',    # Child node ids
+    'name_ids',       # String pool id of the legal name, -1 if missing
+    'spglobal_ids',   # String pool id of the S&P Global id, -1 if missing
+    'pool_offsets',   # Byte offsets into pool_data, one per string plus one
+    'pool_data',      # UTF-8 bytes of all interned strings
+    'keys',           # Requested LEIs, sorted
+    'key_segments',   # Segment holding the hierarchy each requested LEI points at
+    'key_nodes',      # Node id of that hierarchy within its segment
+]
+
+# A store directory holds immutable segment directories and a manifest naming the ones currently published
+MANIFEST = 'MANIFEST.json'
+SEGMENTS_DIR = 'segments'
+
+
+# Hold an exclusive lock on a file for the duration of the block (no-op where fcntl is unavailable)
+@contextmanager
+def file_lock(path):
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# One immutable block of nodes, strings and keys. Keys may point at hierarchies in older segments.
+class _Segment:
+    def __init__(self, segment_id, arrays, path=None):
+        self.id = segment_id
+        self.arrays = arrays
+        self.path = path
+
+    @classmethod
+    def load(cls, segments_path, segment_id):
+        path = os.path.join(segments_path, f"{segment_id:08d}")
+        return cls(segment_id, {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in ARRAYS}, path)
+
+    # Write under a temporary name and rename into place so a segment directory is always complete.
+    # Only called for ids that have never been published, so any directory already using the id is
+    # left over from an interrupted append and is replaced.
+    def save(self, segments_path):
+        path = os.path.join(segments_path, f"{self.id:08d}")
+        tmp_path = tempfile.mkdtemp(prefix=f".tmp-{self.id:08d}-", dir=segments_path)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.asarray(self.arrays[name]))
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        self.path = path
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def string(self, string_id):
+        if string_id < 0:
+            return None
+        offsets = self.arrays['pool_offsets']
+        return bytes(self.arrays['pool_data'][offsets[string_id]:offsets[string_id + 1]]).decode()
+
+    def node_lei(self, node):
+        return self.arrays['node_leis'][node].decode() or None
+
+    def keys_list(self):
+        return [key.decode() for key in self.arrays['keys']]
+
+    # Position of a requested LEI in the sorted keys, or None
+    def search_key(self, lei):
+        keys = self.arrays['keys']
+        encoded = str(lei).encode()
+        if not len(keys) or len(encoded) > keys.dtype.itemsize:
+            return None
+        position = int(np.searchsorted(keys, encoded))
+        if position < len(keys) and keys[position] == encoded:
+            return position
+        return None
+
+    # Node ids of every stored version of an LEI, oldest first
+    def find_nodes(self, lei):
+        node_leis, node_order = self.arrays['node_leis'], self.arrays['node_order']
+        encoded = str(lei).encode()
+        if not len(node_leis) or not encoded or len(encoded) > node_leis.dtype.itemsize:
+            return []
+
+        # Search through node_order without gathering the whole sorted LEI array
+        low, high = 0, len(node_order)
+        while low < high:
+            middle = (low + high) // 2
+            if node_leis[node_order[middle]] < encoded:
+                low = middle + 1
+            else:
+                high = middle
+
+        nodes = []
+        while low < len(node_order) and node_leis[node_order[low]] == encoded:
+            nodes.append(int(node_order[low]))
+            low += 1
+        return sorted(nodes)
+
+    # Rebuild the nested dictionary for a node, in the shape build_hierarchy returns
+    def nested(self, node):
+        offsets = self.arrays['child_offsets']
+        children = {}
+        for child in self.arrays['child_index'][offsets[node]:offsets[node + 1]]:
+            children[self.node_lei(child)] = self.nested(child)
+        return {
+            "name": self.string(self.arrays['name_ids'][node]),
+            "spglobal": self.string(self.arrays['spglobal_ids'][node]),
+            "children": children,
+        }
+
+
+# Collects nested hierarchies into interned nodes and strings before they are packed into a segment
+class _Builder:
+    def __init__(self, segment_id, base=None):
+        self.segment_id = segment_id
+        self.base = base
+        self.leis = []
+        self.children = []
+        self.name_ids = []
+        self.spglobal_ids = []
+        self.nodes = {}
+        self.strings = {}
+        self.keys = {}
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        return self.strings.setdefault(str(value), len(self.strings))
+
+    # Add a node and its descendants. A node is only shared when its LEI, name, S&P Global id and
+    # children all match, so a placeholder left by a failed fetch never replaces a complete subtree.
+    def add_tree(self, lei, details):
+        children = tuple(self.add_tree(child_lei, child_details)
+                         for child_lei, child_details in (details.get('children') or {}).items()
+                         if isinstance(child_details, dict))
+        signature = (lei, self.intern(details.get('name')), self.intern(details.get('spglobal')), children)
+
+        node = self.nodes.get(signature)
+        if node is None:
+            node = self.nodes[signature] = len(self.leis)
+            self.leis.append(lei or '')
+            self.children.append(children)
+            self.name_ids.append(signature[1])
+            self.spglobal_ids.append(signature[2])
+        return node
+
+    # Point a requested LEI at its hierarchy, given as {root_lei: details} like process_single_lei stores it.
+    # An identical tree already in the base store is referenced rather than copied.
+    def add(self, requested_lei, hierarchy):
+        for root_lei, details in hierarchy.items():
+            if isinstance(details, dict):
+                reference = self.base.find_tree(root_lei, details) if self.base is not None else None
+                self.keys[requested_lei] = reference or (self.segment_id, self.add_tree(root_lei, details))
+                return
+        logging.warning(f"No hierarchy found for LEI: {requested_lei}. Skipping item.")
+
+    def build(self):
+        encoded_leis = [lei.encode() for lei in self.leis]
+        node_leis = np.array(encoded_leis, dtype=f"S{max(map(len, encoded_leis), default=1) or 1}")
+
+        child_counts = np.array([len(children) for children in self.children], dtype=np.int64)
+        child_offsets = np.zeros(len(self.children) + 1, dtype=np.int64)
+        np.cumsum(child_counts, out=child_offsets[1:])
+        child_index = np.array([child for children in self.children for child in children], dtype=np.int32)
+
+        encoded_strings = [value.encode() for value in self.strings]
+        pool_offsets = np.zeros(len(encoded_strings) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded_strings], out=pool_offsets[1:])
+        pool_data = np.frombuffer(b''.join(encoded_strings), dtype=np.uint8)
+
+        encoded_keys = sorted((str(lei).encode(), reference) for lei, reference in self.keys.items())
+        keys = np.array([key for key, _ in encoded_keys],
+                        dtype=f"S{max((len(key) for key, _ in encoded_keys), default=1) or 1}")
+
+        return _Segment(self.segment_id, {
+            'node_leis': node_leis,
+            'node_order': np.argsort(node_leis, kind='stable').astype(np.int32),
+            'child_offsets': child_offsets,
+            'child_index': child_index,
+            'name_ids': np.array(self.name_ids, dtype=np.int32),
+            'spglobal_ids': np.array(self.spglobal_ids, dtype=np.int32),
+            'pool_offsets': pool_offsets,
+            'pool_data': pool_data,
+            'keys': keys,
+            'key_segments': np.array([segment_id for _, (segment_id, _) in encoded_keys], dtype=np.int32),
+            'key_nodes': np.array([node for _, (_, node) in encoded_keys], dtype=np.int32),
+        })
+
+
+# Concatenate two adjacent segments into one, shifting node, string and byte offsets of the newer one
+def _merge_segments(older, newer):
+    a, b = older.arrays, newer.arrays
+    node_shift = len(a['node_leis'])
+    string_shift = len(a['pool_offsets']) - 1
+
+    def shift_ids(ids, shift):
+        ids = np.asarray(ids)
+        return np.where(ids < 0, ids, ids + shift).astype(np.int32)
+
+    node_leis = np.concatenate([a['node_leis'], b['node_leis']])
+
+    # Keys pointing into either segment now point into the merged one
+    key_segments = np.concatenate([a['key_segments'], b['key_segments']])
+    key_nodes = np.concatenate([a['key_nodes'], b['key_nodes']])
+    key_nodes = np.where(key_segments == newer.id, key_nodes + node_shift, key_nodes).astype(np.int32)
+    key_segments = np.where(np.isin(key_segments, [older.id, newer.id]), newer.id, key_segments).astype(np.int32)
+    keys = np.concatenate([a['keys'], b['keys']])
+    key_order = np.argsort(keys, kind='stable')
+
+    return _Segment(newer.id, {
+        'node_leis': node_leis,
+        'node_order': np.argsort(node_leis, kind='stable').astype(np.int32),
+        'child_offsets': np.concatenate([a['child_offsets'], b['child_offsets'][1:] + a['child_offsets'][-1]]),
+        'child_index': np.concatenate([a['child_index'], np.asarray(b['child_index']) + node_shift]).astype(np.int32),
+        'name_ids': np.concatenate([a['name_ids'], shift_ids(b['name_ids'], string_shift)]),
+        'spglobal_ids': np.concatenate([a['spglobal_ids'], shift_ids(b['spglobal_ids'], string_shift)]),
+        'pool_offsets': np.concatenate([a['pool_offsets'], b['pool_offsets'][1:] + a['pool_offsets'][-1]]),
+        'pool_data': np.concatenate([a['pool_data'], b['pool_data']]),
+        'keys': keys[key_order],
+        'key_segments': key_segments[key_order],
+        'key_nodes': key_nodes[key_order],
+    })
+
+
+# Delete every directory under segments_path except the segments with the given ids
+def _remove_segments(segments_path, keep):
+    keep = {f"{segment_id:08d}" for segment_id in keep}
+    for name in os.listdir(segments_path):
+        if name not in keep:
+            shutil.rmtree(os.path.join(segments_path, name), ignore_errors=True)
+
+
+# Merge the newest segments while the last is at least half the size of the one before it,
+# so a store that grows by small appends keeps a logarithmic number of segments
+def _compact(segments):
+    while len(segments) >= 2 and 2 * segments[-1].nbytes >= segments[-2].nbytes:
+        segments = segments[:-2] + [_merge_segments(segments[-2], segments[-1])]
+    return segments
+
+
+# Read-only mapping of requested LEI -> {root_lei: {"name", "spglobal", "children": {...}}} backed by
+# flat arrays. Identical subtrees and strings are stored once, so LEIs from the same group share a single tree.
+class HierarchyStore(Mapping):
+    def __init__(self, segments):
+        self.segments = segments
+        self._segments_by_id = {segment.id: segment for segment in segments}
+
+    @classmethod
+    def from_hierarchies(cls, hierarchies):
+        builder = _Builder(0)
+        for requested_lei, hierarchy in hierarchies.items():
+            if isinstance(hierarchy, dict):
+                builder.add(requested_lei, hierarchy)
+            else:
+                logging.warning(f"Expected a dictionary but got {type(hierarchy)} for LEI: {requested_lei}. Skipping item.")
+        return cls([builder.build()])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, MANIFEST))
+
+    @staticmethod
+    def _read_manifest(path):
+        with open(os.path.join(path, MANIFEST), 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def load(cls, path, retries=3):
+        logging.info(f"Memory-mapping cached hierarchies from {path}")
+        segments_path = os.path.join(path, SEGMENTS_DIR)
+        for attempt in range(retries):
+            segment_ids = cls._read_manifest(path)['segments']
+            try:
+                return cls([_Segment.load(segments_path, segment_id) for segment_id in segment_ids])
+            except FileNotFoundError:
+                # A segment was merged away after a newer manifest was published, so read the manifest again
+                if attempt == retries - 1:
+                    raise
+                time.sleep(0.1)
+
+    # Add hierarchies for LEIs not yet cached by writing them as a new segment, then publish it by
+    # atomically replacing the manifest. Writers are serialised by a lock file in the store directory.
+    # When no store has been published yet, base (e.g. the legacy JSON cache) becomes its first segment.
+    @classmethod
+    def append(cls, path, hierarchies, base=None):
+        segments_path = os.path.join(path, SEGMENTS_DIR)
+        os.makedirs(segments_path, exist_ok=True)
+
+        with file_lock(os.path.join(path, '.lock')):
+            if cls.exists(path):
+                manifest = cls._read_manifest(path)
+                previous = manifest['segments']
+                published = manifest['segments'] + manifest.get('previous', [])
+                store = cls.load(path)
+            else:
+                previous = []
+                published = []
+                store = base if base is not None else cls([])
+
+            # Remove segments and temporary directories left by an append that died before publishing
+            _remove_segments(segments_path, keep=published)
+
+            new_hierarchies = {lei: hierarchy for lei, hierarchy in hierarchies.items() if lei not in store}
+            if not new_hierarchies:
+                return store
+
+            builder = _Builder(max((segment.id for segment in store.segments), default=-1) + 1, store)
+            for requested_lei, hierarchy in new_hierarchies.items():
+                builder.add(requested_lei, hierarchy)
+
+            segments = _compact(store.segments + [builder.build()])
+            for segment in segments:
+                if segment.path is None:
+                    segment.save(segments_path)
+
+            manifest_tmp_path = os.path.join(path, f".{MANIFEST}.tmp-{os.getpid()}")
+            with open(manifest_tmp_path, 'w') as f:
+                json.dump({"segments": [segment.id for segment in segments], "previous": previous}, f)
+            os.replace(manifest_tmp_path, os.path.join(path, MANIFEST))
+
+            # Keep the previous segments for readers that opened the old manifest and remove anything older
+            _remove_segments(segments_path, keep=[segment.id for segment in segments] + previous)
+
+            store = cls(segments)
+            logging.info(f"Appended {len(new_hierarchies)} hierarchies to {path} "
+                         f"({len(store)} cached, {len(segments)} segments, {store.nbytes / 1e6:.1f} MB)")
+            return store
+
+    @property
+    def nbytes(self):
+        return sum(segment.nbytes for segment in self.segments)
+
+    # Segment and node of the hierarchy a requested LEI points at, or None
+    def _locate(self, lei):
+        for segment in reversed(self.segments):
+            position = segment.search_key(lei)
+            if position is not None:
+                target = self._segments_by_id[int(segment.arrays['key_segments'][position])]
+                return target, int(segment.arrays['key_nodes'][position])
+        return None
+
+    # Reference to a stored tree identical to {lei: details}, used to avoid copying it into a new segment
+    def find_tree(self, lei, details):
+        for segment in reversed(self.segments):
+            for node in reversed(segment.find_nodes(lei)):
+                if segment.nested(node) == details:
+                    return segment.id, node
+        return None
+
+    # Return the cached tree rooted at an LEI, e.g. an ultimate parent shared by several requested LEIs
+    def subtree(self, lei):
+        # Prefer the most recently stored version that is not a placeholder left by a failed fetch
+        for segment in reversed(self.segments):
+            for node in reversed(segment.find_nodes(lei)):
+                if segment.arrays['name_ids'][node] >= 0:
+                    return {lei: segment.nested(node)}
+        return None
+
+    def __getitem__(self, lei):
+        located = self._locate(lei)
+        if located is None:
+            raise KeyError(lei)
+        segment, node = located
+        return {segment.node_lei(node): segment.nested(node)}
+
+    def __contains__(self, lei):
+        return any(segment.search_key(lei) is not None for segment in self.segments)
+
+    def __iter__(self):
+        for segment in self.segments:
+            yield from segment.keys_list()
+
+    def __len__(self):
+        return sum(len(segment.arrays['keys']) for segment in self.segments)
@@ -0,0 +1,226 @@
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer, util
+from sentence_transformers.models import Normalize, Pooling, Transformer
+
+from hierarchy_store import file_lock
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+
+# Backend and thread count used by the dashboard pages and batch runs, overridable from the environment
+BACKENDS = ['torch', 'quantized', 'onnx']
+DEFAULT_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'torch')
+DEFAULT_THREADS = int(os.environ['EMBEDDING_THREADS']) if os.environ.get('EMBEDDING_THREADS') else None
+ONNX_CACHE_DIR = 'onnx-models'
+
+# Pooling modes the onnx backend reproduces outside the exported graph
+POOLING_MODES = ['pooling_mode_cls_token', 'pooling_mode_max_tokens', 'pooling_mode_mean_tokens']
+
+
+# Wraps the transformer so ONNX export sees its inputs positionally and returns the token embeddings only
+class _TokenEmbeddings(torch.nn.Module):
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs)))[0]
+
+
+# Sentence encoder running a SentenceTransformer model on CPU with fp32, dynamic int8 or onnxruntime inference
+class SentenceEncoder:
+    def __init__(self, model_path, backend=None, threads=None, batch_size=32):
+        backend = backend or DEFAULT_BACKEND
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{backend}', expected one of {BACKENDS}")
+
+        self.backend = backend
+        self.batch_size = batch_size
+        self.threads = threads or DEFAULT_THREADS or torch.get_num_threads()
+
+        self.model = SentenceTransformer(model_path, device='cpu')
+        self.model.eval()
+
+        if backend == 'quantized':
+            # Swap the Linear layers for int8 versions; weights are quantized once, activations per batch
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == 'onnx':
+            self._load_onnx_session(model_path)
+
+        logging.info(f"Loaded {model_path} with the {backend} backend on {self.threads} threads")
+
+    def _load_onnx_session(self, model_path):
+        import onnxruntime as ort
+
+        modules = list(self.model)
+        if not isinstance(modules[0], Transformer) or not isinstance(modules[1], Pooling) \
+                or not all(isinstance(module, Normalize) for module in modules[2:]):
+            raise ValueError(f"The onnx backend only supports Transformer, Pooling and Normalize modules, got {modules}")
+
+        # Exactly one pooling mode must be enabled, and it must be one _pool implements
+        pooling_modes = [key for key, value in modules[1].get_config_dict().items()
+                         if key.startswith('pooling_mode_') and value]
+        if len(pooling_modes) != 1 or pooling_modes[0] not in POOLING_MODES:
+            raise ValueError(f"The onnx backend supports exactly one of {POOLING_MODES}, got {pooling_modes}")
+
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = self.model.max_seq_length
+        self.pooling_mode = pooling_modes[0]
+        self.normalize = len(modules) > 2
+
+        # Key the exported graph on the weights so a retrained model is exported again
+        model_name = os.path.basename(os.path.normpath(model_path))
+        digest = hashlib.sha1()
+        for name, tensor in sorted(modules[0].auto_model.state_dict().items()):
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        os.makedirs(ONNX_CACHE_DIR, exist_ok=True)
+        onnx_path = os.path.join(ONNX_CACHE_DIR, f"{model_name}-{digest.hexdigest()[:16]}.onnx")
+
+        dummy = self.tokenizer(["sample company name"], return_tensors='pt')
+        self.input_names = list(dummy.keys())
+
+        # Processes sharing the cache directory export one at a time, and the graph is written under a
+        # temporary name so a reader never opens a partial file
+        with file_lock(os.path.join(ONNX_CACHE_DIR, '.export.lock')):
+            if not os.path.exists(onnx_path):
+                logging.info(f"Exporting {model_path} to {onnx_path}")
+                dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in self.input_names}
+                dynamic_axes['token_embeddings'] = {0: 'batch', 1: 'sequence'}
+                fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.onnx', dir=ONNX_CACHE_DIR)
+                os.close(fd)
+                try:
+                    torch.onnx.export(
+                        _TokenEmbeddings(modules[0].auto_model, self.input_names),
+                        tuple(dummy[name] for name in self.input_names),
+                        tmp_path,
+                        input_names=self.input_names,
+                        output_names=['token_embeddings'],
+                        dynamic_axes=dynamic_axes,
+                        opset_version=14,
+                    )
+                    os.replace(tmp_path, onnx_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+
+                # Remove graphs exported from earlier weights of the same model
+                for stale_path in glob.glob(os.path.join(ONNX_CACHE_DIR, f"{glob.escape(model_name)}-{'?' * 16}.onnx")):
+                    if stale_path != onnx_path:
+                        os.remove(stale_path)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    # Pool the token embeddings the same way the model's Pooling module does
+    def _pool(self, token_embeddings, attention_mask):
+        mask = attention_mask[..., None].astype(token_embeddings.dtype)
+        if self.pooling_mode == 'pooling_mode_cls_token':
+            embeddings = token_embeddings[:, 0]
+        elif self.pooling_mode == 'pooling_mode_max_tokens':
+            embeddings = np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+        else:
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if self.normalize:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+    def _encode_onnx(self, texts):
+        # Bucket by token length so each batch is only padded to its own longest name
+        lengths = [len(ids) for ids in self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)['input_ids']]
+        order = np.argsort(lengths, kind='stable')
+
+        embeddings = [None] * len(texts)
+        for i in range(0, len(texts), self.batch_size):
+            batch_idx = order[i:i + self.batch_size]
+            inputs = self.tokenizer([texts[j] for j in batch_idx], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors='np')
+            feed = {name: inputs[name].astype(np.int64) for name in self.input_names}
+            token_embeddings = self.session.run(None, feed)[0]
+            for j, embedding in zip(batch_idx, self._pool(token_embeddings, inputs['attention_mask'])):
+                embeddings[j] = embedding
+
+        return torch.from_numpy(np.stack(embeddings))
+
+    # Encode a single string or a list of strings to a tensor of embeddings
+    def encode(self, texts):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+
+        if not texts:
+            return torch.empty(0)
+        if self.backend == 'onnx':
+            embeddings = self._encode_onnx(texts)
+        else:
+            # torch's thread count is process-wide, so only apply this encoder's setting while it runs
+            previous_threads = torch.get_num_threads()
+            torch.set_num_threads(self.threads)
+            try:
+                # SentenceTransformer.encode already sorts the inputs by length before batching
+                embeddings = self.model.encode(texts, batch_size=self.batch_size, convert_to_tensor=True, device='cpu')
+            finally:
+                torch.set_num_threads(previous_threads)
+
+        return embeddings[0] if single else embeddings
+
+
+# Sample names used to compare a backend against the fp32 model
+SAMPLE_NAMES = [
+    "Apple", "Apple Inc.", "APPLE CANADA INC.", "APPLE OPERATIONS INTERNATIONAL LIMITED",
+    "Google llc", "GOOGLE IRELAND LIMITED", "Alphabet Inc.", "Microsoft", "MICROSOFT CORPORATION",
+    "MICROSOFT IRELAND OPERATIONS LIMITED", "Deutsche Bank AG", "DEUTSCHE BANK TRUST COMPANY AMERICAS",
+    "HSBC Holdings plc", "HSBC BANK PLC", "Toyota Motor Corporation", "TOYOTA MOTOR NORTH AMERICA, INC.",
+    "Nestlé S.A.", "NESTLE USA, INC.", "APPLE TEKNOLOJİ VE SATIŞ LİMİTED ŞİRKETİ", "FatCat Analytics Ltd",
+]
+
+
+# Compare the similarity scores of a backend with the fp32 model and report its throughput
+def check_backend(model_path, backend, threads=None, tolerance=0.02, repeat=20):
+    reference = SentenceEncoder(model_path, backend='torch', threads=threads)
+    candidate = SentenceEncoder(model_path, backend=backend, threads=threads)
+
+    queries, entities = SAMPLE_NAMES[::2], SAMPLE_NAMES[1::2]
+    expected = util.pytorch_cos_sim(reference.encode(queries), reference.encode(entities))
+    actual = util.pytorch_cos_sim(candidate.encode(queries), candidate.encode(entities))
+    max_difference = (expected - actual).abs().max().item()
+
+    sentences = SAMPLE_NAMES * repeat
+    report = {}
+    for name, encoder in [('torch', reference), (backend, candidate)]:
+        encoder.encode(SAMPLE_NAMES)  # Warm up
+        start_time = time.perf_counter()
+        encoder.encode(sentences)
+        elapsed = time.perf_counter() - start_time
+        report[name] = len(sentences) / elapsed / encoder.threads
+
+    print(f"Max similarity difference vs fp32: {max_difference:.4f} (tolerance {tolerance})")
+    for name, throughput in report.items():
+        print(f"{name:>10}: {throughput:.1f} sentences/s/core")
+
+    return max_difference <= tolerance
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check parity and throughput of an embedding backend against fp32.")
+    parser.add_argument('--model', default='all-MiniLM-L6-v2', help="SentenceTransformer model name or path")
+    parser.add_argument('--backend', default='quantized', choices=BACKENDS)
+    parser.add_argument('--threads', type=int, help="Intra-op threads (defaults to torch's setting)")
+    parser.add_argument('--tolerance', type=float, default=0.02, help="Allowed absolute difference in cosine similarity")
+    args = parser.parse_args()
+
+    sys.exit(0 if check_backend(args.model, args.backend, args.threads, args.tolerance) else 1)
@@ -3,16 +3,21 @@ import aiohttp
 import pandas as pd
 import logging
 import re
-import torch
 import streamlit as st
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import util
+import inference
+from inference import SentenceEncoder
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
-# Load the pre-trained SentenceTransformer model and force it to run on CPU
-device = torch.device('cpu')
-model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+# Load the pre-trained SentenceTransformer model on CPU once per backend and thread count, shared across reruns
+@st.cache_resource
+def load_model(backend=inference.DEFAULT_BACKEND, threads=inference.DEFAULT_THREADS):
+    return SentenceEncoder('all-MiniLM-L6-v2', backend=backend, threads=threads)
+
+
+model = load_model()
 
 
 # Preprocess company name to remove unnecessary suffixes and special characters
@@ -47,12 +52,6 @@ async def fetch_all_companies(names):
         return results
 
 
-# Function to get embeddings using SentenceTransformer
-def get_embedding(text):
-    preprocessed_text = preprocess_company_name(text)
-    return model.encode(preprocessed_text, convert_to_tensor=True, device=device)
-
-
 # Function to calculate cosine similarity using SentenceTransformer utilities
 def cosine_similarity(embedding1, embedding2):
     return util.pytorch_cos_sim(embedding1, embedding2).item()
@@ -61,6 +60,7 @@ def cosine_similarity(embedding1, embedding2):
 # Function to process and flatten the fetched data into a DataFrame
 def process_results(results):
     records = []
+    matched = []  # (record, preprocessed query name, preprocessed entity name, score boost)
     for name, data in results:
         if data and 'data' in data:
             for entry in data['data']:
@@ -72,22 +72,18 @@ def process_results(results):
                 country = attributes.get('entity', {}).get('legalAddress', {}).get('country', 'N/A')
                 legal_form = attributes.get('entity', {}).get('legalForm', {}).get('abbreviation', 'N/A')
 
-                # Calculate similarity score between the query name and the matched entity name
-                query_embedding = get_embedding(name)
-                entity_embedding = get_embedding(entity_name)
-                similarity = cosine_similarity(query_embedding, entity_embedding)
-
                 # Refine the score based on whether the entity is a corporation and is based in the expected country
+                boost = 1.0
                 keywords = ["corporation", "inc", "limited", "company"]
                 if any(keyword in entity_name.lower() for keyword in keywords):
-                    similarity *= 1.5  # Give a boost to entities with legal identifiers like Corporation or Inc.
+                    boost *= 1.5  # Give a boost to entities with legal identifiers like Corporation or Inc.
 
                 # Further boost the score if the entity is based in the United States
                 if country.lower() in ["us", "united states"]:
-                    similarity *= 1.2  # Higher boost for entities based in the U.S.
+                    boost *= 1.2  # Higher boost for entities based in the U.S.
 
                 # Include legal form in the records
-                records.append({
+                record = {
                     "Query Name": name,
                     "Matched Entity Name": entity_name,
                     "LEI": lei,
@@ -95,8 +91,10 @@ def process_results(results):
                     "City": city,
                     "Country": country,
                     "Legal Form": legal_form,
-                    "Similarity Score": similarity
-                })
+                    "Similarity Score": 0.0
+                }
+                records.append(record)
+                matched.append((record, preprocess_company_name(name), preprocess_company_name(entity_name), boost))
         else:
             logging.warning(f"No data found for {name}")
             records.append({
@@ -110,6 +108,14 @@ def process_results(results):
                 "Similarity Score": 0
             })
 
+    # Calculate similarity scores between the query names and the matched entity names in one batch
+    if matched:
+        texts = list(dict.fromkeys(
+            [query_text for _, query_text, _, _ in matched] + [entity_text for _, _, entity_text, _ in matched]))
+        embeddings = dict(zip(texts, model.encode(texts)))
+        for record, query_text, entity_text, boost in matched:
+            record["Similarity Score"] = cosine_similarity(embeddings[query_text], embeddings[entity_text]) * boost
+
     df = pd.DataFrame(records)
     return df
 